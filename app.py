@@ -1,26 +1,56 @@
-from flask import (Flask, g, render_template, flash,
+from flask import (Flask, Blueprint, g, render_template, flash,
                    redirect, request, url_for, abort)
-from flask_bcrypt import check_password_hash
 from flask_login import (LoginManager, login_user, logout_user,
                          login_required, current_user)
+import click
 import datetime
+import config
 import forms
 import models
 
-# Default values for app
-DEBUG = True
-PORT = 8000
-HOST = '0.0.0.0'
-
-app = Flask(__name__)
-app.secret_key = 'hgd9s8#!.*hjghjfY!^%Rhg54$'
-
 login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = 'login'
+login_manager.login_view = 'journal.login'
 login_manager.login_message = 'Login required.'
 login_manager.login_message_category = 'error'
 
+journal = Blueprint('journal', __name__)
+
+
+def create_app(config_name=None):
+    """Application factory.
+        Binds the database lazily, the schema is checked on the first request.
+        Models share one database per process, so create one app per process:
+        a second call rebinds the database of every app already created.
+    INPUT:
+        config_name - key of config.config, default from JOURNAL_CONFIG
+    RETURNS:
+        app - Flask app
+    """
+    app = Flask(__name__)
+    app.config.from_object(config.get_config(config_name))
+    if not app.config['SECRET_KEY']:
+        raise ValueError("JOURNAL_SECRET_KEY must be set!")
+    app.secret_key = app.config['SECRET_KEY']
+
+    models.init_database(app.config['DATABASE'],
+                         pool_size=app.config['DATABASE_POOL_SIZE'],
+                         shard_count=app.config['SHARD_COUNT'],
+                         shard_directory=app.config['SHARD_DIRECTORY'])
+    login_manager.init_app(app)
+    app.register_blueprint(journal)
+    app.cli.command('migrate-shards')(migrate_shards)
+    return app
+
+
+def migrate_shards():
+    """Moves the entries of the database into the shards.
+        Run once after JOURNAL_SHARD_COUNT is set for an existing database.
+    USAGE:
+        FLASK_APP="app:create_app()" flask migrate-shards
+    """
+    moved = models.migrate_to_shards()
+    click.echo("Moved {} entries into the shards.".format(moved))
+
 
 @login_manager.user_loader
 def load_user(userid):
@@ -40,43 +70,50 @@ def load_user(userid):
         return None
 
 
-@app.before_request
+@journal.before_app_request
 def before_request():
     """Connect to the database before each request.
     DECORATION:
-        before_request from Flask class
+        before_app_request from journal Blueprint
     """
+    models.initialize()
+    models.reset_shard()
     g.db = models.DATABASE
     g.db.connect()
     g.user = current_user
 
 
-@app.after_request
+@journal.after_app_request
 def after_request(response):
     """Close the database connection after each request.
     DECORATION:
-        after_request from Flask class
+        after_app_request from journal Blueprint
     RETURNS:
         response
     """
     g.db.close()
+    models.reset_shard()
     return response
 
 
-@app.route('/')
+@journal.route('/')
 def index():
     """Main page view.
     DECORATION:
-        route from Flask class
+        route from journal Blueprint
     RETURNS:
          render_template from flask - renders index.html template with entries flag
     """
-    entries = models.Entry.select().limit(10).order_by(models.Entry.created_at.desc())
+    entries = models.merge_shards(
+        lambda: models.Entry.select().order_by(models.Entry.created_at.desc()),
+        limit=10)
     return render_template('index.html', entries=entries, view_all=True)
 
 
 def get_object_or_404(slug):
     """Get an object or 404 request.
+        When sharded the slug is routed with EntrySlug and
+        the shard of its user is selected for the request.
     INPUT:
         slug
     RETURNS:
@@ -84,30 +121,34 @@ def get_object_or_404(slug):
         """
     entry_object = None
     try:
+        if models.SHARD.databases:
+            entry_slug = models.EntrySlug.get(models.EntrySlug.slug == slug)
+            models.route_to_shard(entry_slug.user_id)
         entry_object = models.Entry.select().where(models.Entry.slug == slug).get()
     except models.DoesNotExist:
         abort(404)
     return entry_object
 
 
-@app.route('/entries')
+@journal.route('/entries')
 def entry_list():
     """Entry(post) list.
     DECORATION:
-        route from Flask class
+        route from journal Blueprint
         :input: entries
     RETURNS:
          render_template from flask - renders index.html template with entries flag
     """
-    entries = models.Entry.select().order_by(models.Entry.created_at.desc())
+    entries = models.merge_shards(
+        lambda: models.Entry.select().order_by(models.Entry.created_at.desc()))
     return render_template('index.html', entries=entries)
 
 
-@app.route('/entries/<slug>')
+@journal.route('/entries/<slug>')
 def view_entry(slug):
     """Entry(post) detail view.
     DECORATION:
-        route from Flask class
+        route from journal Blueprint
         :input: entries/slug
     INPUT:
         slug
@@ -116,21 +157,17 @@ def view_entry(slug):
                         template with entries, entry_tag flags
     """
     entry_object = get_object_or_404(slug)
-    # noinspection PyUnresolvedReferences
-    entry_tags = (models.Tag.select()
-                            .join(models.EntryTag)
-                            .join(models.Entry)
-                            .where(models.Entry.id == entry_object.id))
+    entry_tags = entry_object.get_tags()
     if not entry_object:
         abort(404)
     return render_template('detail.html', entry=entry_object, entry_tags=entry_tags)
 
 
-@app.route('/entries/<username>')
+@journal.route('/entries/<username>')
 def user_entries(username):
     """User entry(post) view.
     DECORATION:
-        route from Flask class
+        route from journal Blueprint
         :input: entries/username
     INPUT:
         username
@@ -141,11 +178,11 @@ def user_entries(username):
     entries = None
     entry_list_tags = []
     try:
-        entries = (models.User.select()
-                              .where(models.User.username == username)
-                              .get()
-                              .entries
-                              .order_by(models.Entry.created_at.desc()))
+        user = (models.User.select()
+                           .where(models.User.username == username)
+                           .get())
+        models.route_to_shard(user.id)
+        entries = user.entries.order_by(models.Entry.created_at.desc())
     except models.DoesNotExist:
         abort(404)
     return render_template('index.html',
@@ -154,11 +191,11 @@ def user_entries(username):
                            view_all=True)
 
 
-@app.route('/entries/tag/<tagid>')
+@journal.route('/entries/tag/<tagid>')
 def entries_tag(tagid):
     """Entries(posts) tag view.
     DECORATION:
-        route from Flask class
+        route from journal Blueprint
         :input: entries/slug/tag_id
     INPUT:
         tagid
@@ -173,19 +210,110 @@ def entries_tag(tagid):
     except models.DoesNotExist:
         abort(404)
     # noinspection PyUnresolvedReferences
-    entries = (models.Entry.select()
-                           .join(models.EntryTag)
-                           .join(models.Tag)
-                           .where(models.Tag.id == tagid))
+    entries = models.merge_shards(
+        lambda: (models.Entry.select()
+                             .join(models.EntryTag)
+                             .where(models.EntryTag.tag == tagid)
+                             .order_by(models.Entry.created_at.desc())))
     return render_template('index.html', entries=entries, view_all=True)
 
 
-@app.route('/entry', methods=('GET', 'POST'))
+def get_month_or_404(year, month):
+    """Get the date range of a month or 404 request.
+    INPUT:
+        year
+        month
+    RETURNS:
+        (start, end) - datetime range of the month
+    """
+    try:
+        return models.month_range(year, month)
+    except ValueError:
+        abort(404)
+
+
+@journal.route('/archive')
+@journal.route('/archive/<int:year>/<int:month>')
+def archive(year=None, month=None):
+    """Archive view. Entries(posts) of all users by month,
+        the latest month with entries if no month is given.
+    DECORATION:
+        route from journal Blueprint
+        :input: archive or archive/year/month
+    INPUT:
+        year - default=None
+        month - default=None
+    RETURNS:
+        render_template from flask - renders archive.html
+                        template with entries, archive, year and month flags
+    """
+    archive_counts = models.archive_counts()
+    if year is None and archive_counts:
+        year = archive_counts[0]['year']
+        month = archive_counts[0]['months'][0][0]
+    entries = []
+    if year is not None:
+        start, end = get_month_or_404(year, month)
+        # noinspection PyUnresolvedReferences
+        entries = models.merge_shards(
+            lambda: (models.Entry.select()
+                                 .where((models.Entry.created_at >= start) &
+                                        (models.Entry.created_at < end))
+                                 .order_by(models.Entry.created_at.desc())))
+    return render_template('archive.html',
+                           entries=entries,
+                           archive=archive_counts,
+                           year=year,
+                           month=month)
+
+
+@journal.route('/timeline/<username>')
+@journal.route('/timeline/<username>/<int:year>/<int:month>')
+def user_timeline(username, year=None, month=None):
+    """User timeline view. Entries(posts) of an user by month,
+        the latest month with entries if no month is given.
+    DECORATION:
+        route from journal Blueprint
+        :input: timeline/username or timeline/username/year/month
+    INPUT:
+        username
+        year - default=None
+        month - default=None
+    RETURNS:
+        render_template from flask - renders archive.html
+                        template with entries, archive, username, year and month flags
+    """
+    try:
+        user = models.User.get(models.User.username == username)
+    except models.DoesNotExist:
+        abort(404)
+    models.route_to_shard(user.id)
+    archive_counts = models.archive_counts(user.id)
+    if year is None and archive_counts:
+        year = archive_counts[0]['year']
+        month = archive_counts[0]['months'][0][0]
+    entries = []
+    if year is not None:
+        start, end = get_month_or_404(year, month)
+        # noinspection PyUnresolvedReferences
+        entries = (user.entries
+                       .where((models.Entry.created_at >= start) &
+                              (models.Entry.created_at < end))
+                       .order_by(models.Entry.created_at.desc()))
+    return render_template('archive.html',
+                           entries=entries,
+                           archive=archive_counts,
+                           username=username,
+                           year=year,
+                           month=month)
+
+
+@journal.route('/entry', methods=('GET', 'POST'))
 @login_required
 def entry():
     """Entry(post) create view.
     DECORATION:
-        route from Flask class
+        route from journal Blueprint
         login_required from flask_login
         :input: entry(post) with GET and POST methods
     RETURNS:
@@ -205,16 +333,16 @@ def entry():
             resources=form.resources.data.strip(),
         )
         flash("Entry created!", "success")
-        return redirect(url_for('index'))
+        return redirect(url_for('journal.index'))
     return render_template('new.html', form=form)
 
 
-@app.route('/entries/edit/<slug>', methods=('GET', 'POST'))
+@journal.route('/entries/edit/<slug>', methods=('GET', 'POST'))
 @login_required
 def edit_entry(slug):
     """Entry(post) view.
     DECORATION:
-        route from Flask class
+        route from journal Blueprint
         login_required from flask_login
         :input: entries/slug/edit with GET and POST methods
     INPUT:
@@ -228,27 +356,24 @@ def edit_entry(slug):
     entry_object = get_object_or_404(slug)
     form = forms.PostEntryForm(obj=entry_object)
     if form.validate_on_submit():
-        # noinspection PyUnresolvedReferences
-        query = models.Entry.update(
-            user=g.user._get_current_object(),
+        entry_object.edit_entry(
             title=form.title.data.strip(),
             created_at=(form.created_at.data or datetime.datetime.now()),
             duration=form.duration.data,
             content=form.content.data.strip(),
             resources=form.resources.data.strip(),
-        ).where(models.Entry.id == entry_object.id)
-        query.execute()
+        )
         flash("Entry updated!", "success")
-        return redirect(url_for('index'))
+        return redirect(url_for('journal.index'))
     return render_template('new.html', form=form)
 
 
-@app.route('/tags/create', methods=('GET', 'POST'))
+@journal.route('/tags/create', methods=('GET', 'POST'))
 @login_required
 def tag():
     """Tag view.
     DECORATION:
-        route from Flask class
+        route from journal Blueprint
         login_required from flask_login
         :input: tags/create with GET and POST methods
     RETURNS:
@@ -260,16 +385,16 @@ def tag():
     if form.validate_on_submit():
         models.Tag.create(name=form.name.data)
         flash("Tag created!", "success")
-        return redirect(url_for('index'))
+        return redirect(url_for('journal.index'))
     return render_template('tag.html', form=form)
 
 
-@app.route('/entries/tags/<slug>', methods=('GET', 'POST'))
+@journal.route('/entries/tags/<slug>', methods=('GET', 'POST'))
 @login_required
 def apply_tag(slug):
     """Apply tag view.
     DECORATION:
-        route from Flask class
+        route from journal Blueprint
         login_required from flask_login
         :input: entries/slug/tags with GET and POST methods
     INPUT:
@@ -290,7 +415,7 @@ def apply_tag(slug):
         existing_entry_tags = []
 
         for entry_tag in entry_tags:
-            existing_entry_tags += [entry_tag.tag.id]
+            existing_entry_tags += [entry_tag.tag_id]
         for selection in request.form.getlist('tags'):
             if int(selection) in existing_entry_tags:
                 continue
@@ -299,16 +424,16 @@ def apply_tag(slug):
                 tag=selection
             )
         flash("Tags applied!", "success")
-        return redirect(url_for('view_entry', slug=slug))
+        return redirect(url_for('journal.view_entry', slug=slug))
     return render_template('apply_tag.html', form=form, tags=tags, slug=slug)
 
 
-@app.route('/entries/<slug>/tags/remove', methods=('GET', 'POST'))
+@journal.route('/entries/<slug>/tags/remove', methods=('GET', 'POST'))
 @login_required
 def remove_tag(slug):
     """Remove tag view.
     DECORATION:
-        route from Flask class
+        route from journal Blueprint
         login_required from flask_login
         :input: entries/slug/tags/remove with GET and POST methods
     INPUT:
@@ -324,30 +449,28 @@ def remove_tag(slug):
     e_id = entry_object.id
     entry_tags = (models.EntryTag.select()
                                  .where(models.EntryTag.entry == e_id))
-    entry_tag_id = [entry_tag.tag.id for entry_tag in entry_tags]
+    entry_tag_id = [entry_tag.tag_id for entry_tag in entry_tags]
     # noinspection PyUnresolvedReferences
     tags = models.Tag.select().where(models.Tag.id << entry_tag_id)
     form.tags.choices = [(x.id, x.name) for x in tags]
     if form.validate_on_submit():
         selections = [int(x) for x in request.form.getlist('tags')]
-        # noinspection PyUnresolvedReferences
-        tags = models.Tag.select().where(models.Tag.id << selections)
         query = models.EntryTag.delete().where(
             (models.EntryTag.entry == entry_object) &
-            (models.EntryTag.tag << tags)
+            (models.EntryTag.tag << selections)
         )
         query.execute()
         flash("Tags removed", "success")
-        return redirect(url_for('view_entry', slug=slug))
+        return redirect(url_for('journal.view_entry', slug=slug))
     return render_template('remove_tag.html', form=form, tags=tags, slug=slug)
 
 
-@app.route('/entries/delete/<slug>', methods=('GET', 'POST'))
+@journal.route('/entries/delete/<slug>', methods=('GET', 'POST'))
 @login_required
 def remove_entry(slug):
     """Remove entry(post) view.
     DECORATION:
-        route from Flask class
+        route from journal Blueprint
         login_required from flask_login
         :input: entries/slug/delete with GET and POST methods
     INPUT:
@@ -361,17 +484,17 @@ def remove_entry(slug):
     entry_object = get_object_or_404(slug)
     form = forms.RemoveEntryForm()
     if form.validate_on_submit():
-        models.Entry.delete_instance(entry_object)
+        entry_object.delete_entry()
         flash("Entry deleted!", "success")
-        return redirect(url_for('entry_list'))
+        return redirect(url_for('journal.entry_list'))
     return render_template('delete.html', entry=entry_object, form=form)
 
 
-@app.route('/register', methods=('GET', 'POST'))
+@journal.route('/register', methods=('GET', 'POST'))
 def register():
     """Register view. Create an user.
     DECORATION:
-        route from Flask class
+        route from journal Blueprint
         :input: register with GET and POST methods
     RETURNS:
         redirect to view home page if form submit is valid
@@ -387,21 +510,23 @@ def register():
             email=form.email.data,
             password=form.password.data
         )
-        return redirect(url_for('index'))
+        return redirect(url_for('journal.index'))
     return render_template('register.html', form=form)
 
 
-@app.route('/login', methods=('GET', 'POST'))
+@journal.route('/login', methods=('GET', 'POST'))
 def login():
     """Login view. Uses login_user from flask_login to login user(creates a session),
         Check the password with check_password_hash from flask_bcrypt to check password.
     DECORATION:
-        route from Flask class
+        route from journal Blueprint
         :input: /login with GET and POST methods
     RETURNS:
         render_template from flask - renders login.html
                                     with form flag
     """
+    from flask_bcrypt import check_password_hash
+
     form = forms.LoginForm()
     if form.validate_on_submit():
         try:
@@ -412,30 +537,30 @@ def login():
             if check_password_hash(user.password, form.password.data):
                 login_user(user)
                 flash("You've been logged in!", "success")
-                return redirect(url_for('index'))
+                return redirect(url_for('journal.index'))
             else:
                 flash("Your email or password doesn't match!", "error")
     return render_template('login.html', form=form)
 
 
-@app.route('/logout')
+@journal.route('/logout')
 @login_required
 def logout():
     """Logout view. Uses logout_user from flask_login to logout user(close the session)
     DECORATION:
         login_required from flask_login
-        route from Flask class
+        route from journal Blueprint
         :input: /logout with GET and POST methods
     RETURNS:
         render_template from flask - renders index.html(home page)
     """
     logout_user()
     flash("You've been logged out!", "success")
-    return redirect(url_for('index'))
+    return redirect(url_for('journal.index'))
 
 
 if __name__ == '__main__':
-    models.initialize()
+    app = create_app('development')
 #     try:
 #         models.User.create_user(
 #             username='test_user',
@@ -445,4 +570,6 @@ if __name__ == '__main__':
 #         )
 #     except ValueError:
 #         pass
-    app.run(debug=DEBUG, host=HOST, port=PORT)
+    app.run(debug=app.config['DEBUG'],
+            host=app.config['HOST'],
+            port=app.config['PORT'])
@@ -0,0 +1,62 @@
+"""Startup benchmark.
+    Measures the time from importing app to the first response of the index page
+    in a fresh interpreter, like a newly started worker.
+    Every run works on its own copy of record.db, so each one includes
+    the schema check and the tracked database is never changed.
+    USAGE:
+        python bench_startup.py [runs]
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+WORKER = '''
+import time
+start = time.perf_counter()
+import app
+flask_app = app.create_app()
+imported = time.perf_counter()
+response = flask_app.test_client().get('/')
+done = time.perf_counter()
+assert response.status_code == 200, response.status_code
+print(imported - start, done - start)
+'''
+
+
+def measure():
+    """Run one cold start in a new interpreter
+    RETURNS:
+        (import seconds, first response seconds)
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, 'record.db')
+        shutil.copy(os.path.join(HERE, 'record.db'), database)
+        env = dict(os.environ,
+                   JOURNAL_DATABASE=database,
+                   JOURNAL_SHARD_DIRECTORY=os.path.join(directory, 'shards'),
+                   JOURNAL_SHARD_COUNT='0',
+                   JOURNAL_SECRET_KEY='bench')
+        output = subprocess.check_output([sys.executable, '-c', WORKER],
+                                         cwd=HERE, env=env)
+    imported, first_response = output.decode().split()
+    return float(imported), float(first_response)
+
+
+def main(runs=5):
+    """Run the benchmark and print the best and average times
+    INPUT:
+        runs - number of cold starts, default=5
+    """
+    results = [measure() for _ in range(runs)]
+    for index, label in enumerate(('import + create_app', 'first response')):
+        times = [result[index] * 1000 for result in results]
+        print('{:<20} best {:8.2f} ms  avg {:8.2f} ms'.format(
+            label, min(times), sum(times) / len(times)))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,46 @@
+import os
+
+
+class Config(object):
+    """Base configuration for the app
+        Values can be overridden with environment variables
+    """
+    DEBUG = False
+    PORT = int(os.environ.get('JOURNAL_PORT', 8000))
+    HOST = os.environ.get('JOURNAL_HOST', '0.0.0.0')
+    # Required outside of development, create_app fails without it
+    SECRET_KEY = os.environ.get('JOURNAL_SECRET_KEY')
+    DATABASE = os.environ.get('JOURNAL_DATABASE', 'record.db')
+    # 0 means a plain SqliteDatabase, anything above uses a connection pool
+    DATABASE_POOL_SIZE = int(os.environ.get('JOURNAL_DATABASE_POOL_SIZE', 0))
+    # 0 keeps entries in DATABASE, anything above splits them over shard files
+    SHARD_COUNT = int(os.environ.get('JOURNAL_SHARD_COUNT', 0))
+    SHARD_DIRECTORY = os.environ.get('JOURNAL_SHARD_DIRECTORY', 'shards')
+
+
+class DevelopmentConfig(Config):
+    """Configuration for local development"""
+    DEBUG = True
+    SECRET_KEY = os.environ.get('JOURNAL_SECRET_KEY', 'hgd9s8#!.*hjghjfY!^%Rhg54$')
+
+
+class ProductionConfig(Config):
+    """Configuration for deployed workers"""
+    DEBUG = False
+
+
+config = {
+    'development': DevelopmentConfig,
+    'production': ProductionConfig,
+    'default': ProductionConfig,
+}
+
+
+def get_config(name=None):
+    """Select a configuration class
+    INPUT:
+        name - key of config, default is JOURNAL_CONFIG environment variable
+    RETURNS:
+        configuration class
+    """
+    return config[name or os.environ.get('JOURNAL_CONFIG', 'default')]
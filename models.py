@@ -1,13 +1,56 @@
+import collections
 import datetime
+import glob
+import heapq
+import itertools
+import os
+import threading
+from contextlib import contextmanager
 
-from flask_bcrypt import generate_password_hash
 from flask_login import UserMixin
-from slugify import slugify
 
 from peewee import *
 
 
-DATABASE = SqliteDatabase('record.db')
+class ShardRouter(object):
+    """Database of Entry and EntryTag Models
+        Forwards every call to the shard selected for the current thread.
+        Without shards it forwards to DATABASE.
+    """
+    def __init__(self):
+        self.databases = []
+        self._local = threading.local()
+
+    @property
+    def current(self):
+        """
+        RETURNS:
+             the selected shard database, DATABASE if not sharded
+        """
+        database = getattr(self._local, 'database', None)
+        if database is not None:
+            return database
+        if self.databases:
+            raise InterfaceError("No shard selected for Entry query.")
+        return DATABASE
+
+    def set_shard(self, database):
+        """Select the shard database for the current thread
+        INPUT:
+            database - shard database or None to clear it
+        """
+        self._local.database = database
+
+    def __getattr__(self, attr):
+        return getattr(self.current, attr)
+
+
+# Bound to a real database by init_database() when the app is created.
+# Holds User, Tag and EntrySlug, the directory when sharded.
+DATABASE = Proxy()
+SHARD = ShardRouter()
+_schema_checked = False
+_schema_lock = threading.Lock()
 
 
 class User(UserMixin, Model):
@@ -29,9 +72,10 @@ class User(UserMixin, Model):
     def get_entry(self):
         """Select user from the database
         RETURNS:
-            user which equals with the object instance
+            user which equals with the object instance,
+            bound to the shard of the user when sharded
         """
-        return Entry.select().where(Entry.user == self)
+        return Entry.select().where(Entry.user == self).bind(shard_for(self.id) or SHARD)
 
     @classmethod
     def create_user(cls, username, email, password, admin=False):
@@ -43,6 +87,8 @@ class User(UserMixin, Model):
             password - hashes password with generate_password_hash from flask_bcrypt
             admin - default=False
         """
+        from flask_bcrypt import generate_password_hash
+
         try:
             with DATABASE.transaction():
                 cls.create(
@@ -64,15 +110,18 @@ class Entry(Model):
     duration = IntegerField()
     content = TextField()
     resources = TextField()
-    created_at = DateTimeField(default=datetime.datetime.now)
+    created_at = DateTimeField(default=datetime.datetime.now, index=True)
     slug = CharField(unique=True)
     user = ForeignKeyField(
         User, related_name='entries'
     )
 
     class Meta:
-        database = DATABASE
+        database = SHARD
         order_by = ('-created_at',)
+        indexes = (
+            (('user', 'created_at'), False),
+        )
 
     @classmethod
     def create_entry(cls, title, duration, content, resources, created_at, user):
@@ -85,10 +134,15 @@ class Entry(Model):
              resources (resources to remember)
              created_at (date)
              user - related to User Model
+            When sharded the slug is registered in EntrySlug first,
+            the entry is created in the shard of the user.
         """
+        from slugify import slugify
+
         slug = slugify(title)
         slugs = []
-        for x in cls.select(cls.slug).where(cls.slug.contains(slug)):
+        slug_model = EntrySlug if SHARD.databases else cls
+        for x in slug_model.select(slug_model.slug).where(slug_model.slug.startswith(slug)):
             slugs.append(x.slug)
         if slugs:
             slug_check = slug
@@ -97,24 +151,71 @@ class Entry(Model):
                 slug_check = slug + str(slug_number)
                 slug_number += 1
             slug = slug_check
-        cls.create(title=title,
-                   duration=duration,
-                   content=content,
-                   resources=resources,
-                   created_at=created_at,
-                   user=user,
-                   slug=slug)
+        entry_slug = None
+        if SHARD.databases:
+            entry_slug = EntrySlug.create(slug=slug, user=user)
+        try:
+            with use_shard(user.id), SHARD.atomic():
+                cls.create(title=title,
+                           duration=duration,
+                           content=content,
+                           resources=resources,
+                           created_at=created_at,
+                           user=user,
+                           slug=slug)
+                EntryMonth.add(user.id, created_at, 1)
+        except Exception:
+            # free the slug again, it would point to a missing entry
+            if entry_slug is not None:
+                entry_slug.delete_instance()
+            raise
 
-    def get_tags(self):
+    def edit_entry(self, title, duration, content, resources, created_at):
+        """Updates the entry(post), moves it to the new month in EntryMonth
+        INPUT:
+             title
+             duration (time_spent)
+             content (what you learned)
+             resources (resources to remember)
+             created_at (date)
         """
+        with use_shard(self.user_id), SHARD.atomic():
+            # noinspection PyUnresolvedReferences
+            Entry.update(
+                title=title,
+                duration=duration,
+                content=content,
+                resources=resources,
+                created_at=created_at,
+            ).where(Entry.id == self.id).execute()
+            EntryMonth.add(self.user_id, self.created_at, -1)
+            EntryMonth.add(self.user_id, created_at, 1)
+
+    def delete_entry(self):
+        """Deletes the entry(post) from its shard and its slug from EntrySlug
+            The slug is deleted first and restored if the shard delete fails.
+        """
+        if SHARD.databases:
+            EntrySlug.delete().where(EntrySlug.slug == self.slug).execute()
+        try:
+            with use_shard(self.user_id), SHARD.atomic():
+                self.delete_instance()
+                EntryMonth.add(self.user_id, self.created_at, -1)
+        except Exception:
+            if SHARD.databases:
+                EntrySlug.create(slug=self.slug, user=self.user_id)
+            raise
+
+    def get_tags(self):
+        """Tag ids are read from the entry's shard, tags from DATABASE
         RETURNS:
              a peewee model select with all of the entry's tags
         """
+        with use_shard(self.user_id):
+            tag_ids = [entry_tag.tag_id for entry_tag in
+                       EntryTag.select(EntryTag.tag).where(EntryTag.entry == self.id)]
         # noinspection PyUnresolvedReferences
-        tags = (Tag.select()
-                .join(EntryTag)
-                .join(Entry)
-                .where(Entry.id == self.id))
+        tags = Tag.select().where(Tag.id << tag_ids)
         return tags
 
 
@@ -139,14 +240,342 @@ class EntryTag(Model):
     entry = ForeignKeyField(Entry, related_name='entries')
     tag = ForeignKeyField(Tag, related_name='tags')
 
+    class Meta:
+        database = SHARD
+
+
+class EntryMonth(Model):
+    """Model for entry count per user and month
+        Kept up to date on create, edit and delete,
+        so archive navigation never scans the Entry table.
+        Lives in the same shard as the user's entries.
+    INHERIT:
+        Model from peewee
+    """
+    user = ForeignKeyField(User, related_name='months')
+    year = IntegerField()
+    month = IntegerField()
+    count = IntegerField(default=0)
+
+    class Meta:
+        database = SHARD
+        indexes = (
+            (('user', 'year', 'month'), True),
+        )
+
+    @classmethod
+    def add(cls, user_id, date, amount):
+        """Adds amount to the count of the month of date
+        INPUT:
+            user_id
+            date - created_at of an entry
+            amount - 1 for a new entry, -1 for a removed one
+        """
+        # noinspection PyUnresolvedReferences
+        updated = (cls.update(count=cls.count + amount)
+                      .where((cls.user == user_id) &
+                             (cls.year == date.year) &
+                             (cls.month == date.month))
+                      .execute())
+        if not updated:
+            cls.create(user=user_id, year=date.year, month=date.month, count=amount)
+
+    @classmethod
+    def rebuild(cls):
+        """Recounts every month from the Entry table of the selected shard
+            Used when the table is created or entries were moved to shards
+        """
+        counts = collections.Counter(
+            (entry.user_id, entry.created_at.year, entry.created_at.month)
+            for entry in Entry.select(Entry.user, Entry.created_at)
+        )
+        cls.delete().execute()
+        for (user_id, year, month), count in counts.items():
+            cls.create(user=user_id, year=year, month=month, count=count)
+
+
+class EntrySlug(Model):
+    """Model for entry slug, only used when sharded
+        Routes a slug to the user whose shard holds the entry
+    INHERIT:
+        Model from peewee
+    """
+    slug = CharField(unique=True)
+    user = ForeignKeyField(User, related_name='slugs')
+
     class Meta:
         database = DATABASE
 
 
+def _create_database(path, pool_size=0):
+    """Create a sqlite database
+    INPUT:
+        path - sqlite database file
+        pool_size - max connections in the pool, default=0 (no pool)
+    RETURNS:
+        database
+    """
+    if pool_size:
+        from playhouse.pool import PooledSqliteDatabase
+        return PooledSqliteDatabase(path, max_connections=pool_size)
+    return SqliteDatabase(path)
+
+
+def init_database(path, pool_size=0, shard_count=0, shard_directory='shards'):
+    """Create the database and bind it to the models
+        Uses a connection pool if pool_size is set.
+        With shard_count entries and entry tags are split over
+        shard_count files, a user always lands in the same file.
+    INPUT:
+        path - sqlite database file
+        pool_size - max connections in the pool, default=0 (no pool)
+        shard_count - number of shard files, default=0 (not sharded)
+        shard_directory - folder of the shard files
+    RETURNS:
+        database
+    """
+    global _schema_checked
+    database = _create_database(path, pool_size)
+    DATABASE.initialize(database)
+    SHARD.databases = []
+    if shard_count:
+        os.makedirs(shard_directory, exist_ok=True)
+        existing = glob.glob(os.path.join(shard_directory, 'record-*.db'))
+        if existing and len(existing) != shard_count:
+            # users are bucketed by user_id % shard_count
+            raise ValueError("Shard count can't be changed, {} has {} shard files!"
+                             .format(shard_directory, len(existing)))
+        SHARD.databases = [
+            _create_database(os.path.join(shard_directory, 'record-{}.db'.format(number)),
+                             pool_size)
+            for number in range(shard_count)
+        ]
+    _schema_checked = False
+    return database
+
+
+def shard_for(user_id):
+    """
+    INPUT:
+        user_id
+    RETURNS:
+        shard database of the user, None if not sharded
+    """
+    if not SHARD.databases:
+        return None
+    return SHARD.databases[int(user_id) % len(SHARD.databases)]
+
+
+def route_to_shard(user_id):
+    """Select the shard of the user for the rest of the request
+    INPUT:
+        user_id
+    """
+    SHARD.set_shard(shard_for(user_id))
+
+
+def reset_shard():
+    """Clear the selected shard and close opened shard connections"""
+    SHARD.set_shard(None)
+    for database in SHARD.databases:
+        if not database.is_closed():
+            database.close()
+
+
+def each_shard():
+    """Selects every shard in turn, runs once if not sharded
+    RETURNS:
+        generator of shard databases, None if not sharded
+    """
+    previous = getattr(SHARD._local, 'database', None)
+    try:
+        for database in SHARD.databases or [None]:
+            SHARD.set_shard(database or previous)
+            yield database
+    finally:
+        SHARD.set_shard(previous)
+
+
+@contextmanager
+def use_shard(user_id):
+    """Select the shard of the user inside a with block
+    INPUT:
+        user_id
+    """
+    previous = getattr(SHARD._local, 'database', None)
+    SHARD.set_shard(shard_for(user_id) or previous)
+    try:
+        yield
+    finally:
+        SHARD.set_shard(previous)
+
+
+def merge_shards(query_builder, limit=None):
+    """Runs an entry query on every shard and merges them newest first
+    INPUT:
+        query_builder - function returning an Entry select
+                        ordered by created_at descending
+        limit - max number of entries, default=None (all)
+    RETURNS:
+         the query itself if not sharded
+         else a list of entries
+    """
+    if not SHARD.databases:
+        query = query_builder()
+        return query.limit(limit) if limit else query
+    results = []
+    for _ in each_shard():
+        query = query_builder()
+        results.append(list(query.limit(limit) if limit else query))
+    merged = heapq.merge(*results, key=lambda x: x.created_at, reverse=True)
+    return list(itertools.islice(merged, limit))
+
+
+def month_range(year, month):
+    """
+    INPUT:
+        year
+        month
+    RETURNS:
+        (first moment of the month, first moment of the next month)
+    """
+    start = datetime.datetime(year, month, 1)
+    if month == 12:
+        return start, datetime.datetime(year + 1, 1, 1)
+    return start, datetime.datetime(year, month + 1, 1)
+
+
+def archive_counts(user_id=None):
+    """Entry counts per year and month read from EntryMonth
+    INPUT:
+        user_id - counts of one user, default=None (all users)
+    RETURNS:
+        list of years newest first, each a dict with
+        year, count and months - list of (month, count) newest first
+    """
+    counts = collections.Counter()
+    if user_id is not None:
+        with use_shard(user_id):
+            for row in EntryMonth.select().where(EntryMonth.user == user_id):
+                counts[(row.year, row.month)] += row.count
+    else:
+        for _ in each_shard():
+            query = (EntryMonth.select(EntryMonth.year,
+                                       EntryMonth.month,
+                                       fn.SUM(EntryMonth.count).alias('total'))
+                               .group_by(EntryMonth.year, EntryMonth.month))
+            for row in query:
+                counts[(row.year, row.month)] += row.total
+    years = []
+    for (year, month), count in sorted(counts.items(), reverse=True):
+        if count <= 0:
+            continue
+        if not years or years[-1]['year'] != year:
+            years.append({'year': year, 'count': 0, 'months': []})
+        years[-1]['count'] += count
+        years[-1]['months'].append((month, count))
+    return years
+
+
+def _create_entry_month(rebuild=False):
+    """Creates EntryMonth in the selected shard, filled from existing entries
+        Runs in one transaction that takes the write lock before reading,
+        so starting workers wait for each other instead of failing with
+        "database is locked", and no count added meanwhile is lost.
+    INPUT:
+        rebuild - recount an existing table too, default=False
+    """
+    if EntryMonth.table_exists() and not rebuild:
+        return
+    with SHARD.transaction(lock_type='IMMEDIATE'):
+        if not EntryMonth.table_exists():
+            EntryMonth.create_table()
+            EntryMonth.rebuild()
+        elif rebuild:
+            EntryMonth.rebuild()
+
+
+def migrate_to_shards():
+    """Moves entries and entry tags of DATABASE into the shards
+        One-off command for turning on sharding for an existing database,
+        run by `flask migrate-shards`. DATABASE stays write locked until
+        its entry tables are renamed to <table>_unsharded, so no entry
+        written meanwhile is lost. Entries already copied to their shard
+        are skipped, so an interrupted migration can run again.
+    RETURNS:
+        number of entries moved
+    """
+    if not SHARD.databases:
+        raise ValueError("Sharding is not turned on!")
+    DATABASE.create_tables([User, Tag, EntrySlug], safe=True)
+    for database in each_shard():
+        database.create_tables([Entry, EntryTag], safe=True)
+    names = [EntryTag._meta.table_name, EntryMonth._meta.table_name,
+             Entry._meta.table_name]
+    with DATABASE.transaction(lock_type='IMMEDIATE'):
+        tables = DATABASE.get_tables()
+        if Entry._meta.table_name not in tables:
+            return 0
+        SHARD.set_shard(DATABASE)
+        try:
+            entries = list(Entry.select())
+            entry_tags = collections.defaultdict(list)
+            if EntryTag._meta.table_name in tables:
+                for entry_tag in EntryTag.select():
+                    entry_tags[entry_tag.entry_id].append(entry_tag.tag_id)
+        finally:
+            SHARD.set_shard(None)
+        for entry in entries:
+            with use_shard(entry.user_id), SHARD.transaction(lock_type='IMMEDIATE'):
+                if not Entry.select().where(Entry.slug == entry.slug).exists():
+                    moved = Entry.create(title=entry.title,
+                                         duration=entry.duration,
+                                         content=entry.content,
+                                         resources=entry.resources,
+                                         created_at=entry.created_at,
+                                         user=entry.user_id,
+                                         slug=entry.slug)
+                    for tag_id in entry_tags[entry.id]:
+                        EntryTag.create(entry=moved.id, tag=tag_id)
+            EntrySlug.get_or_create(slug=entry.slug, defaults={'user': entry.user_id})
+        for name in names:
+            if name in tables:
+                DATABASE.execute_sql('ALTER TABLE "{0}" RENAME TO "{0}_unsharded"'.format(name))
+    for database in each_shard():
+        _create_entry_month(rebuild=True)
+        database.close()
+    return len(entries)
+
+
 def initialize():
     """Initialize the database
-        Creates tables after close it
+        Creates tables after close it, only once per process
     """
+    if _schema_checked:
+        return
+    with _schema_lock:
+        _initialize()
+
+
+def _initialize():
+    """Creates the tables of DATABASE and every shard, called by initialize"""
+    global _schema_checked
+    if _schema_checked:
+        return
     DATABASE.connect()
-    DATABASE.create_tables([User, Entry, EntryTag, Tag], safe=True)
-    DATABASE.close()
+    try:
+        if SHARD.databases:
+            if Entry._meta.table_name in DATABASE.get_tables():
+                raise ValueError("Entries of DATABASE are not in the shards, "
+                                 "run `flask migrate-shards` first!")
+            DATABASE.create_tables([User, Tag, EntrySlug], safe=True)
+            for database in each_shard():
+                database.create_tables([Entry, EntryTag], safe=True)
+                _create_entry_month()
+                database.close()
+        else:
+            DATABASE.create_tables([User, Entry, EntryTag, Tag], safe=True)
+            _create_entry_month()
+    finally:
+        DATABASE.close()
+    _schema_checked = True